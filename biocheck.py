@@ -1,12 +1,12 @@
 import argparse
+import functools
+import itertools
 import logging
 import os
 import pathlib
 import sys
 from datetime import datetime, timedelta
 
-from lxml import etree
-
 
 logger = logging.getLogger(__name__)
 
@@ -33,6 +33,108 @@ NSOWS = "{http://www.opengis.net/ows/2.0}"
 NSXLINK = "{http://www.w3.org/1999/xlink}"
 NSXSD = "{http://www.w3.org/2001/XMLSchema}"
 
+# XPath expressions used when scanning the MPH and schema files (compiled once, see xpath())
+NAMESPACES = {"bio": NSBIO[1:-1], "eop": NSEOP[1:-1], "ows": NSOWS[1:-1], "xlink": NSXLINK[1:-1], "xsd": NSXSD[1:-1]}
+XPATH_PROCESSING_DATE = ".//eop:processingDate"
+XPATH_PRODUCT_INFORMATION = ".//bio:ProductInformation"
+XPATH_HREF = "eop:fileName/ows:ServiceReference/@xlink:href"
+XPATH_SIZE = "eop:size"
+XPATH_RDS = "bio:rds"
+XPATH_XSD_INCLUDE = "xsd:include | xsd:import"
+
+# timeout (in seconds) for downloading a remote schema
+DOWNLOAD_TIMEOUT = 60
+
+
+def schema_cache_dir():
+    """Return the directory with local copies of remote schemas (such as the OGC schemas imported by the built-in
+    MPH schema), or None if no cache directory can be determined (e.g. if there is no home directory).
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    if not cache_home:
+        try:
+            cache_home = pathlib.Path.home() / ".cache"
+        except (RuntimeError, KeyError):
+            return None
+    return pathlib.Path(cache_home) / "biocheck" / "xsd"
+
+
+def _fetch_remote_schema(url):
+    """Return the contents of a remote (http/https) schema, or None if the URL is not a remote one.
+
+    Schemas that are not in the cache yet are downloaded once and stored in schema_cache_dir(). Cache entries are
+    named after a hash of the URL, so a URL can never refer to a location outside the cache directory. Downloads
+    that are not an XML Schema (such as an error page from a proxy) are returned but not cached.
+    """
+    import hashlib
+    import urllib.parse
+    import urllib.request
+
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        return None
+    cache_dir = schema_cache_dir()
+    if cache_dir is not None:
+        path = cache_dir / (hashlib.sha256(url.encode("utf-8")).hexdigest() + ".xsd")
+        try:
+            return path.read_bytes()
+        except OSError:
+            pass
+    try:
+        with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT) as response:
+            data = response.read()
+    except OSError as exc:
+        logger.debug(f"could not download '{url}' ({exc})")
+        return None
+    from lxml import etree
+
+    try:
+        is_schema = etree.fromstring(data, get_parser()).tag == f"{NSXSD}schema"
+    except etree.Error:
+        is_schema = False
+    if not is_schema:
+        logger.debug(f"download of '{url}' is not an XML Schema; not storing it in cache")
+        return data
+    if cache_dir is None:
+        return data
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmppath = path.with_name(f".{path.name}.{os.getpid()}")
+        tmppath.write_bytes(data)
+        os.replace(tmppath, path)
+    except OSError as exc:
+        logger.debug(f"could not store '{url}' in cache ({exc})")
+    return data
+
+
+# parser that is shared by all parse calls (see get_parser())
+_PARSER = None
+
+
+def get_parser():
+    """Return the XML parser that is shared by all parse calls (each worker process gets its own copy).
+
+    ID collection and entity resolution are not needed for the checks that are performed and are therefore
+    disabled. Remote schema references are resolved via the local schema cache (the original URL is kept as base
+    URL, so relative references inside a remote schema are resolved and cached in the same way).
+    The parser is created on first use, so lxml is only imported when it is actually needed.
+    """
+    global _PARSER
+    if _PARSER is None:
+        from lxml import etree
+
+        class CachingResolver(etree.Resolver):
+            def resolve(self, url, pubid, context):
+                data = _fetch_remote_schema(url)
+                if data is None:
+                    return None
+                return self.resolve_string(data, context, base_url=url)
+
+        _PARSER = etree.XMLParser(collect_ids=False, resolve_entities=False)
+        _PARSER.resolvers.add(CachingResolver())
+    return _PARSER
+
+
 # This is created with:
 # xsltproc filter.xslt bio.xsd | xmllint --format -
 # with filter.xslt being:
@@ -209,63 +311,188 @@ builtin_mph_schema = """<?xml version="1.0"?>
 </schema>
 """
 
+# compiled XML Schemas (see load_xmlschema()), keyed by schema path and modification time
+_SCHEMA_CACHE = {}
+
 
 def base36encode(number):
     """Converts an integer to a base36 string."""
     alphabet = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
     if not isinstance(number, int):
         raise TypeError("number must be an integer")
-    base36 = ""
     sign = ""
     if number < 0:
         sign = "-"
         number = -number
     if 0 <= number < len(alphabet):
         return sign + alphabet[number]
+    digits = []
     while number != 0:
         number, i = divmod(number, len(alphabet))
-        base36 = alphabet[i] + base36
-    return sign + base36
+        digits.append(alphabet[i])
+    return sign + "".join(reversed(digits))
 
 
-def check_file_against_schema(xmlfile, schema):
+@functools.lru_cache(maxsize=None)
+def xpath(expression):
+    """Return the compiled XPath object for an expression that uses the prefixes from NAMESPACES."""
+    from lxml import etree
+
+    return etree.XPath(expression, namespaces=NAMESPACES)
+
+
+def schema_name(schema):
+    """Return the name of a schema file or built-in schema string for use in messages."""
+    if isinstance(schema, str) and schema.startswith("<?xml"):
+        return "built-in schema"
+    return schema
+
+
+def load_xmlschema(schema):
+    """Return the compiled XML Schema for a schema file or a built-in schema string.
+
+    Compiled schemas are cached, so a schema that is shared by many files (or products) is only parsed once.
+    Raises etree.Error if the schema could not be parsed.
+    """
+    from lxml import etree
+
     if isinstance(schema, str) and schema.startswith("<?xml"):
-        xmlschema = etree.XMLSchema(etree.fromstring(schema))
-        schema = "built-in schema"
+        key = (schema,)
     else:
-        try:
+        key = (os.fspath(schema), os.stat(schema).st_mtime_ns)
+    if key not in _SCHEMA_CACHE:
+        if len(key) == 1:
+            _SCHEMA_CACHE[key] = etree.XMLSchema(etree.fromstring(schema, get_parser()))
+        else:
             etree.clear_error_log()
-            xmlschema = etree.XMLSchema(etree.parse(os.fspath(schema)).getroot())
-        except etree.Error as exc:
-            logger.error(f"could not parse schema '{schema}'")
-            for error in exc.error_log:
-                logger.error(f"{error.filename}:{error.line}: {error.message}")
-            return False
+            _SCHEMA_CACHE[key] = etree.XMLSchema(etree.parse(os.fspath(schema), get_parser()).getroot())
+    return _SCHEMA_CACHE[key]
+
+
+def schema_errors(tree, schema):
+    """Validate a parsed XML document against a schema and return the list of error messages.
+
+    The list is empty if the document is valid.
+    """
+    from lxml import etree
+
     try:
-        etree.clear_error_log()
-        xmlschema.assertValid(etree.parse(os.fspath(xmlfile)))
-    except etree.DocumentInvalid as exc:
-        logger.error(f"could not verify '{xmlfile}' against schema '{schema}'")
-        for error in exc.error_log:
-            logger.error(f"{error.filename}:{error.line}: {error.message}")
+        xmlschema = load_xmlschema(schema)
+    except etree.Error as exc:
+        return [f"could not parse schema '{schema_name(schema)}'"] + \
+            [f"{error.filename}:{error.line}: {error.message}" for error in exc.error_log]
+    if not xmlschema.validate(tree):
+        return [f"could not verify '{tree.docinfo.URL}' against schema '{schema_name(schema)}'"] + \
+            [f"{error.filename}:{error.line}: {error.message}" for error in xmlschema.error_log]
+    return []
+
+
+def check_tree_against_schema(tree, schema):
+    errors = schema_errors(tree, schema)
+    for error in errors:
+        logger.error(error)
+    if errors:
         return False
-    logger.debug(f"file '{xmlfile}' valid according to schema '{schema}'")
+    logger.debug(f"file '{tree.docinfo.URL}' valid according to schema '{schema_name(schema)}'")
     return True
 
 
+def check_file_against_schema(xmlfile, schema):
+    from lxml import etree
+
+    return check_tree_against_schema(etree.parse(os.fspath(xmlfile), get_parser()), schema)
+
+
+def _validate_one(filepath, schemafile):
+    """Validate a product component against its schema.
+
+    This function is run in worker processes, so it does not log anything itself. It returns the list of parse or
+    schema validation error messages (empty if the file is valid).
+    """
+    from lxml import etree
+
+    try:
+        etree.clear_error_log()
+        tree = etree.parse(os.fspath(filepath), get_parser())
+    except etree.Error as exc:
+        return [f"could not parse xml file '{filepath}'"] + \
+            [f"{error.filename}:{error.line}: {error.message}" for error in exc.error_log]
+    return schema_errors(tree, schemafile)
+
+
+# process pool for schema validation (see get_executor())
+_EXECUTOR = None
+_EXECUTOR_WORKERS = 0
+
+
+def get_executor(workers):
+    """Return the process pool for schema validation, with at least the given number of worker processes.
+
+    The pool is shared by all products that are checked, so each worker keeps its schema cache for the whole run.
+    It is only recreated when a product needs more workers than the current pool has. The pool is shut down at
+    exit (or earlier, with shutdown_executor()).
+    """
+    import atexit
+    import concurrent.futures
+
+    global _EXECUTOR, _EXECUTOR_WORKERS
+    if _EXECUTOR is None:
+        atexit.register(shutdown_executor)
+    if _EXECUTOR is None or _EXECUTOR_WORKERS < workers:
+        shutdown_executor()
+        _EXECUTOR = concurrent.futures.ProcessPoolExecutor(workers)
+        _EXECUTOR_WORKERS = workers
+    return _EXECUTOR
+
+
+def shutdown_executor():
+    """Shut down the process pool for schema validation (if there is one), cancelling any pending jobs."""
+    global _EXECUTOR, _EXECUTOR_WORKERS
+    if _EXECUTOR is not None:
+        _EXECUTOR.shutdown(cancel_futures=True)
+        _EXECUTOR = None
+        _EXECUTOR_WORKERS = 0
+
+
+def _iter_files(root):
+    """Yield a (path, size) tuple for all files below the given directory (with the path as a string).
+
+    This uses os.scandir(), so the file type of each entry comes from the directory listing and the file sizes
+    are collected during the same walk.
+    """
+    directories = [root]
+    while directories:
+        directory = directories.pop()
+        try:
+            entries = os.scandir(directory)
+        except PermissionError:
+            # skip directories that cannot be read (as Path.rglob() does)
+            logger.debug(f"could not read directory '{directory}'")
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.is_file():
+                    yield entry.path, entry.stat().st_size
+
+
 def is_xml(filename):
-    filename = pathlib.Path(filename)
-    return filename.suffix.lower() == ".xml" and filename.name[0] != "."
+    name = os.path.basename(os.fspath(filename))
+    return name.lower().endswith(".xml") and not name.startswith(".")
 
 
 def locate_schema_include_files(schemafiles, files):
+    from lxml import etree
+
     for schemafile in schemafiles:
         try:
-            schema = etree.parse(os.fspath(schemafile))
-            for entry in schema.findall(f"{NSXSD}include") + schema.findall(f"{NSXSD}import"):
-                schemalocation = schemafile.parent / entry.get("schemaLocation")
-                if schemalocation in files:
-                    files.remove(schemalocation)
+            schema = etree.parse(os.fspath(schemafile), get_parser())
+            for entry in xpath(XPATH_XSD_INCLUDE)(schema):
+                schemalocation = os.path.normpath(os.path.join(os.path.dirname(schemafile),
+                                                               entry.get("schemaLocation")))
+                if os.path.normcase(schemalocation) in files:
+                    files.discard(os.path.normcase(schemalocation))
                     # find schemafiles recusively
                     locate_schema_include_files([schemalocation], files)
         except:
@@ -274,6 +501,8 @@ def locate_schema_include_files(schemafiles, files):
 
 
 def verify_biomass_product(product, use_mph_schema=False):
+    from lxml import etree
+
     has_errors = False
     has_warnings = False
 
@@ -288,48 +517,76 @@ def verify_biomass_product(product, use_mph_schema=False):
         logger.error(f"could not find '{mphfile}'")
         return 2
 
-    if use_mph_schema:
-        if not check_file_against_schema(mphfile, builtin_mph_schema):
-            has_errors = True
     try:
         etree.clear_error_log()
-        mph = etree.parse(os.fspath(mphfile))
+        mph = etree.parse(os.fspath(mphfile), get_parser())
     except etree.Error as exc:
         logger.error(f"could not parse xml file '{mphfile}'")
         for error in exc.error_log:
             logger.error(f"{error.filename}:{error.line}: {error.message}")
         return 2
+    if use_mph_schema:
+        # validate the already parsed MPH, instead of reading and parsing the file a second time
+        if not check_tree_against_schema(mph, builtin_mph_schema):
+            has_errors = True
 
     # check encoded creation date in product name
     epoch = datetime(2000, 1, 1)
-    mph_date = mph.find(f".//{NSEOP}processingDate").text
-    try:
-        compact_mph_date = \
-            base36encode(int((datetime.strptime(mph_date, "%Y-%m-%dT%H:%M:%SZ") - epoch).total_seconds()))
-    except ValueError as exc:
-        logger.error(f"invalid value for processingDate in '{mphfile}' ({str(exc)})")
+    compact_creation_date = product.name[-6:]
+    mph_date_element = next(iter(xpath(XPATH_PROCESSING_DATE)(mph)), None)
+    if mph_date_element is None:
+        logger.error(f"missing processingDate in '{mphfile}'")
         has_errors = True
-    else:
-        compact_creation_date = product.name[-6:]
+    try:
         creation_date = (epoch + timedelta(seconds=int(compact_creation_date, 36))).strftime("%Y-%m-%dT%H:%M:%SZ")
-        if compact_creation_date != compact_mph_date:
-            logger.error(f"compact creation date in '{product}' ({creation_date}|{compact_creation_date}) does not "
-                         f"match processing date from MPH ({mph_date}|{compact_mph_date})")
+    except (ValueError, OverflowError):
+        logger.error(f"invalid compact creation date in '{product}' ({compact_creation_date})")
+        has_errors = True
+        creation_date = None
+    if mph_date_element is not None:
+        mph_date = mph_date_element.text
+        try:
+            compact_mph_date = \
+                base36encode(int((datetime.strptime(mph_date, "%Y-%m-%dT%H:%M:%SZ") - epoch).total_seconds()))
+        except (TypeError, ValueError) as exc:
+            logger.error(f"invalid value for processingDate in '{mphfile}' ({str(exc)})")
             has_errors = True
-
-    # find list of files in product
-    files = [item for item in product.rglob("*") if item.is_file()]
-    schemafiles = []
-    files.remove(mphfile)
+        else:
+            if creation_date is not None and compact_creation_date != compact_mph_date:
+                logger.error(f"compact creation date in '{product}' ({creation_date}|{compact_creation_date}) does "
+                             f"not match processing date from MPH ({mph_date}|{compact_mph_date})")
+                has_errors = True
+
+    # find set of files in product; paths are kept as strings, which is cheaper than pathlib for large products.
+    # Files are identified by their os.path.normcase() path (so they match case-insensitively on Windows, as
+    # pathlib paths do); the paths as found on disk are kept for opening files and for messages.
+    product_str = os.path.normpath(os.fspath(product))
+    paths = {}
+    sizes = {}
+    for path, size in _iter_files(product_str):
+        paths[os.path.normcase(path)] = path
+        sizes[os.path.normcase(path)] = size
+    files = set(paths)
+    schemafiles = {}
+    files.discard(os.path.normcase(os.path.normpath(os.fspath(mphfile))))
+    jobs = []
 
     # check files that are referenced in manifest file
-    for product_info in mph.findall(f".//{NSBIO}ProductInformation"):
-        href = product_info.find(f"{NSEOP}fileName/{NSOWS}ServiceReference").get(f"{NSXLINK}href")
+    find_href = xpath(XPATH_HREF)
+    find_size = xpath(XPATH_SIZE)
+    find_rds = xpath(XPATH_RDS)
+    for product_info in xpath(XPATH_PRODUCT_INFORMATION)(mph):
+        href = next(iter(find_href(product_info)), None)
+        if href is None:
+            logger.error(f"missing file reference for ProductInformation in '{mphfile}' (line "
+                         f"{product_info.sourceline})")
+            has_errors = True
+            continue
         if href == product.name:
             continue
-        filepath = product / href
-        if filepath in files:
-            files.remove(filepath)
+        filekey = os.path.normcase(os.path.normpath(os.path.join(product_str, href)))
+        if filekey in files:
+            files.discard(filekey)
             check_file = True
         else:
             logger.error(f"MPH reference '{href}' does not exist in product '{product}'")
@@ -338,36 +595,68 @@ def verify_biomass_product(product, use_mph_schema=False):
 
         # extract schema file reference
         schemafile = None
-        rds = product_info.find(f"{NSBIO}rds")
+        rds = next(iter(find_rds(product_info)), None)
         if rds is not None:
-            schemafile = product / rds.text
-            if schemafile not in schemafiles:
-                if schemafile in files:
-                    schemafiles.append(schemafile)
-                    files.remove(schemafile)
+            schemafile = os.path.normpath(os.path.join(product_str, rds.text))
+            schemakey = os.path.normcase(schemafile)
+            if schemakey not in schemafiles:
+                if schemakey in files:
+                    schemafiles[schemakey] = paths[schemakey]
+                    files.discard(schemakey)
                 else:
                     logging.error(f"schema file '{schemafile}' does not exist")
                     has_errors = True
 
         if check_file:
             # check file size
-            size_element = product_info.find(f"{NSEOP}size")
+            file_ok = True
+            size_element = next(iter(find_size(product_info)), None)
             if size_element is not None:
-                filesize = filepath.stat().st_size
-                if filesize != int(size_element.text):
-                    logger.error(f"file size for '{href}' ({filesize}) does not match file size in MPH "
-                                 f"({size_element.text}) for product '{product}'")
-                    has_errors = True
-            # check against XML Schema (if there is one)
-            if schemafile is not None and schemafile in schemafiles:
-                if not check_file_against_schema(filepath, schemafile):
+                try:
+                    expected_size = int(size_element.text)
+                except (TypeError, ValueError):
+                    logger.error(f"invalid file size for '{href}' ({size_element.text}) in MPH for product "
+                                 f"'{product}'")
                     has_errors = True
+                else:
+                    filesize = sizes[filekey]
+                    if filesize != expected_size:
+                        logger.error(f"file size for '{href}' ({filesize}) does not match file size in MPH "
+                                     f"({size_element.text}) for product '{product}'")
+                        has_errors = True
+                        file_ok = False
+            # check against XML Schema (if there is one); a file with the wrong size is already known to be bad
+            if schemafile is not None and schemakey in schemafiles:
+                if file_ok:
+                    jobs.append((paths[filekey], schemafiles[schemakey]))
+                else:
+                    logger.debug(f"skipping schema validation of '{href}' because of size mismatch")
+
+    # validation is CPU bound, so spread it over multiple processes, unless there are only a few files to check
+    # (in which case starting the worker processes costs more than it saves)
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    workers = min(cpus, len(jobs))
+    if len(jobs) < 4 or workers == 1:
+        results = list(itertools.starmap(_validate_one, jobs))
+    else:
+        executor = get_executor(workers)
+        results = list(executor.map(_validate_one, *zip(*jobs), chunksize=len(jobs) // (4 * workers) + 1))
+    for (filepath, schemafile), errors in zip(jobs, results):
+        for error in errors:
+            logger.error(error)
+        if errors:
+            has_errors = True
+        else:
+            logger.debug(f"file '{filepath}' valid according to schema '{schemafile}'")
 
-    locate_schema_include_files(schemafiles, files)
+    locate_schema_include_files(schemafiles.values(), files)
 
     # report on files in the BIOMASS product that are not referenced by the MPH
-    for file in files:
-        logging.warning(f"file '{file.relative_to(product)}' found in product '{product}' "
+    for file in sorted(files):
+        logging.warning(f"file '{os.path.relpath(paths[file], product_str)}' found in product '{product}' "
                         "but not included in MPH or schemas")
         has_warnings = True
 
@@ -382,30 +671,25 @@ def main():
     logging.basicConfig(format="%(levelname)s: %(message)s", stream=sys.stdout)
     logging.captureWarnings(True)
 
-    # This parser is used in combination with the parse_known_args() function as a way to implement a "--version"
-    # option that prints version information and exits, and is included in the help message.
-    #
     # The "--version" option should have the same semantics as the "--help" option in that if it is present on the
     # command line, the corresponding action should be invoked directly, without checking any other arguments.
-    # However, the argparse module does not support user defined options with such semantics.
-    version_parser = argparse.ArgumentParser(add_help=False)
-    version_parser.add_argument("--version", action="store_true", help="output version information and exit")
-
-    parser = argparse.ArgumentParser(prog="biocheck", description=__doc__, parents=[version_parser])
-    parser.add_argument("-q", "--quiet", action="store_true",
-                        help="suppress standard output messages and warnings, only errors are printed to screen")
-    parser.add_argument("-s", "--schema", action="store_true",
-                        help="verify Main Product Header against schema (requires internet access)")
-    parser.add_argument("products", nargs="+", metavar="<BIOMASS product>")
-
-    args, unused_args = version_parser.parse_known_args()
-    if args.version:
+    # However, the argparse module does not support user defined options with such semantics, so we check for it
+    # before parsing the command line (the option is still added to the parser to include it in the help message).
+    # Like argparse, we accept abbreviations of the option (no other long option starts with "--v").
+    if any(len(arg) > 2 and "--version".startswith(arg) for arg in sys.argv[1:]):
         print(f"biocheck v{__version__}")
         print(__copyright__)
         print()
         sys.exit(0)
 
-    args = parser.parse_args(unused_args)
+    parser = argparse.ArgumentParser(prog="biocheck", description=__doc__)
+    parser.add_argument("--version", action="store_true", help="output version information and exit")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="suppress standard output messages and warnings, only errors are printed to screen")
+    parser.add_argument("-s", "--schema", action="store_true",
+                        help="verify Main Product Header against schema (requires internet access on first use)")
+    parser.add_argument("products", nargs="+", metavar="<BIOMASS product>")
+    args = parser.parse_args()
 
     logging.getLogger().setLevel("ERROR" if args.quiet else "INFO")
     try:
@@ -424,6 +708,8 @@ def main():
         raise
     except KeyboardInterrupt:
         sys.exit(1)
+    finally:
+        shutdown_executor()
 
 
 if __name__ == "__main__":